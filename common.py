@@ -1,4 +1,9 @@
 import re
+import logging
+
+
+
+_RE_WS = re.compile(r"[\s]+")
 
 
 
@@ -38,24 +43,25 @@ def color_log(log):
             return " ".join([_format(v) for v in args]), args
         return args[0], args[1:]
 
-    def _message(args, color):
-        message, args = message_args(args)
-        return "".join([color, message, color_end])
+    def build_method(safe, color, levelno):
+        method = getattr(log, safe)
 
-    def _args(args):
-        args = message_args(args)[1]
-        return args
+        def log_message(*args, **kwargs):
+            # Skip message formatting when the record would be dropped.
+            if not log.isEnabledFor(levelno):
+                return
+            message, args = message_args(args)
+            method("".join([color, message, color_end]), *args, **kwargs)
 
-    def build_lambda(safe, color):
-        return lambda *args, **kwargs: getattr(log, safe)(
-            _message(args, color), *_args(args), **kwargs)
+        return log_message
 
     for (level, color) in level_colors:
         safe = "%s_" % level
         setattr(log, safe, getattr(log, level))
-        setattr(log, level, build_lambda(safe, color))
+        setattr(log, level, build_method(
+            safe, color, getattr(logging, level.upper())))
 
 
 
 def clean_whitespace(text):
-    return re.sub(r"[\s]+", " ", text).strip()
+    return _RE_WS.sub(" ", text).strip()
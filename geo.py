@@ -1,9 +1,11 @@
 import re
 import math
 import logging
+import warnings
+import functools
 
 import numpy as np
-from bs4 import BeautifulSoup
+from lxml import etree
 
 from common import clean_whitespace
 
@@ -13,18 +15,96 @@ LOG = logging.getLogger("geo")
 
 
 
+NS_INKSCAPE = "http://www.inkscape.org/namespaces/inkscape"
+NS_SODIPODI = "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+
+# Maximum distance, in output units (mm), of a flattened Bézier from the
+# curve. It is scaled into path units by each path's transform.
+BEZIER_TOLERANCE = 0.05
+BEZIER_MAX_DEPTH = 16
+
+SKIP_TAGS = frozenset(["metadata", "defs"])
+
+
+
+_RE_MM = re.compile(r"^([0-9.]+)\s*mm$", re.U)
+_RE_CM = re.compile(r"^([0-9.]+)\s*cm$", re.U)
+_RE_IN = re.compile(r"^([0-9.]+)\s*in$", re.U)
+
+_RE_PATH_COMMAND = re.compile(
+    r"([MmLlHhVvCcSsQqTtAaZz])\s*([^MmLlHhVvCcSsQqTtAaZz]*)")
+_RE_PATH_NUMBER = re.compile(
+    r"[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?")
+
+# Below this length, per-call overhead makes `np.fromstring` slower than
+# converting regex matches one by one.
+_FROMSTRING_MIN_LENGTH = 256
+_COMMA_TABLE = str.maketrans(",", " ")
+
+_RE_XFORM_MATRIX = re.compile(r"""
+matrix\(
+([0-9.e-]+),
+([0-9.e-]+),
+([0-9.e-]+),
+([0-9.e-]+),
+([0-9.e-]+),
+([0-9.e-]+)
+\)""", re.X)
+
+_RE_XFORM_TRANSLATE = re.compile(r"""
+translate\(
+([0-9.e-]+),
+([0-9.e-]+)
+\)
+""", re.X)
+
+_RE_XFORM_TRANSLATE1 = re.compile(r"""
+translate\(
+([0-9.e-]+)
+\)
+""", re.X)
+
+_RE_XFORM_ROTATE = re.compile(r"""
+rotate\(
+([0-9.e-]+)
+\)
+""", re.X)
+
+_RE_XFORM_ROTATE3 = re.compile(r"""
+rotate\(
+([0-9.e-]+),
+([0-9.e-]+),
+([0-9.e-]+)
+\)
+""", re.X)
+
+_RE_XFORM_SCALE = re.compile(r"""
+scale\(
+([0-9.e-]+),
+([0-9.e-]+)
+\)
+""", re.X)
+
+_RE_XFORM_SCALE1 = re.compile(r"""
+scale\(
+([0-9.e-]+)
+\)
+""", re.X)
+
+
+
 def text_to_mm(text):
     text = text.strip().lower()
 
-    match = re.compile(r"^([0-9.]+)\s*mm$", re.U).match(text)
+    match = _RE_MM.match(text)
     if match:
         return float(match.group(1))
 
-    match = re.compile(r"^([0-9.]+)\s*cm$", re.U).match(text)
+    match = _RE_CM.match(text)
     if match:
         return float(match.group(1)) * 10
 
-    match = re.compile(r"^([0-9.]+)\s*in$", re.U).match(text)
+    match = _RE_IN.match(text)
     if match:
         return float(match.group(1)) * 25.4
 
@@ -38,99 +118,208 @@ def text_to_mm(text):
 
 
 def transform_poly(poly, xform):
-    poly2 = []
-    for vertex in poly:
-        v1 = np.matrix([[vertex[0]], [vertex[1]], [1]])
-        v2 = xform * v1
-        poly2.append([v2[0, 0], v2[1, 0]])
-    return poly2
+    """
+    Apply a 3x3 affine `xform` to every vertex in a single product.
+    """
+
+    xform = np.asarray(xform)
+    pts = np.asarray(poly, dtype=np.float64).reshape(-1, 2)
+    out = pts @ xform[:2, :2].T + xform[:2, 2]
+    return out.tolist()
 
 
 
-def poly_points_bezier(_command, cursor, segment, absolute):
+def transform_poly_list(poly_list, xform):
     """
-    Return absolute points
+    Apply a 3x3 affine `xform` to all polygons in a single product.
     """
 
-    vertex_list = [tuple(cursor)]
-    while segment:
-        vertex = tuple(segment[:2])
-        segment = segment[2:]
+    sizes = [len(poly) for poly in poly_list]
+    flat = [vertex for poly in poly_list for vertex in poly]
+    flat = transform_poly(flat, xform)
 
-        if absolute:
-            vertex_list.append(tuple(vertex))
-        else:
-            vertex_list.append((
-                cursor[0] + vertex[0],
-                cursor[1] + vertex[1]
-            ))
-
-    def point(p0, p1, p2, p3, t):
-        return (
-            p0 * pow((1 - t), 3) +
-            p1 * 3 * pow((1 - t), 2) * t +
-            p2 * 3 * (1 - t) * pow(t, 2) +
-            p3 * pow(t, 3)
-        )
-
-    def ang_diff(a1, a2):
-        diff = a2 - a1
-        if diff > math.pi:
-            diff -= 2 * math.pi
-        if diff < -math.pi:
-            diff += 2 * math.pi
-        return diff
-
-    p = vertex_list
-
-    a1 = math.atan2(p[1][1] - p[0][1], p[1][0] - p[0][0])
-    a2 = math.atan2(p[2][1] - p[1][1], p[2][0] - p[1][0])
-    a3 = math.atan2(p[3][1] - p[2][1], p[3][0] - p[2][0])
-
-    d1 = ang_diff(a1, a2)
-    d2 = ang_diff(a2, a3)
-    dx = p[3][0] - p[0][0]
-    dy = p[3][1] - p[0][1]
-
-    length = math.sqrt(dx * dx + dy * dy)
-    d = abs(d1) + abs(d2)
+    out_list = []
+    start = 0
+    for size in sizes:
+        out_list.append(flat[start:start + size])
+        start += size
+    return out_list
+
+
+
+def _flat(p0, p1, p2, p3, tolerance2):
+    """
+    Return whether a cubic Bézier is within `sqrt(tolerance2)` of its chord.
+
+    The curve lies within the hull of its control points, so it is close
+    enough if both inner points are. Distances are compared squared to
+    avoid the square root.
+    """
+
+    chord = p3 - p0
+    length2 = chord.real * chord.real + chord.imag * chord.imag
+    for q in (p1, p2):
+        d = q - p0
+        if length2:
+            # Offset from the nearest point on the chord segment.
+            s = (d.real * chord.real + d.imag * chord.imag) / length2
+            if s > 1:
+                d -= chord
+            elif s > 0:
+                d -= s * chord
+        if d.real * d.real + d.imag * d.imag >= tolerance2:
+            return False
+    return True
+
+
+
+def bezier_points(p, tolerance=BEZIER_TOLERANCE):
+    """
+    Return complex points along a cubic Bézier, excluding the start.
+
+    `p` is the four control points as complex numbers, x + yj. The curve
+    is halved with De Casteljau's algorithm until both inner control
+    points of each piece lie within `tolerance` of its chord, so the
+    number of points follows the curvature.
+    """
+
+    tolerance2 = tolerance * tolerance
+    points = []
+    stack = [(tuple(p), 0)]
+    while stack:
+        ((p0, p1, p2, p3), depth) = stack.pop()
+        if (depth >= BEZIER_MAX_DEPTH or
+                _flat(p0, p1, p2, p3, tolerance2)):
+            points.append(p3)
+            continue
+
+        p01 = (p0 + p1) / 2
+        p12 = (p1 + p2) / 2
+        p23 = (p2 + p3) / 2
+        p012 = (p01 + p12) / 2
+        p123 = (p12 + p23) / 2
+        mid = (p012 + p123) / 2
+
+        # Second half first so that the first half is popped next.
+        stack.append(((mid, p123, p23, p3), depth + 1))
+        stack.append(((p0, p01, p012, mid), depth + 1))
+
+    return points
+
+
+
+def accumulate(cursor, offsets):
+    """
+    Return absolute points for an (N, 2) array of offsets, each relative
+    to the point before it, starting from `cursor`.
+    """
+
+    return np.cumsum(np.vstack([cursor, offsets]), axis=0)[1:]
+
+
+
+def poly_points_bezier(_command, cursor, values, absolute,
+                       tolerance=BEZIER_TOLERANCE):
+    """
+    Return absolute points for a run of cubic Bézier segments
+    """
+
+    if not values:
+        return []
+
+    ctrl = np.asarray(values, dtype=np.float64).reshape(-1, 3, 2)
+    if absolute:
+        starts = np.vstack([cursor, ctrl[:-1, 2]])
+    else:
+        ends = accumulate(cursor, ctrl[:, 2])
+        starts = np.vstack([cursor, ends[:-1]])
+        ctrl = ctrl + starts[:, None, :]
+
+    # Points are complex numbers, x + yj, so each step of arithmetic
+    # handles both coordinates.
+    starts = (starts[:, 0] + 1j * starts[:, 1]).tolist()
+    ctrl = (ctrl[..., 0] + 1j * ctrl[..., 1]).tolist()
 
     vertex_list = []
-    n = 1 + int(10 * d) +  int(length / 100)
-    for i in range(n):
-        t = float(i + 1) / n
-        x = point(p[0][0], p[1][0], p[2][0], p[3][0], t)
-        y = point(p[0][1], p[1][1], p[2][1], p[3][1], t)
-        vertex_list.append((x, y))
+    for start, points in zip(starts, ctrl):
+        vertex_list += [
+            (z.real, z.imag)
+            for z in bezier_points([start, *points], tolerance)]
 
     return vertex_list
 
 
 
-def poly_points_linear(command, cursor, segment, absolute):
+def poly_points_linear(command, cursor, values, absolute):
     """
-    Return absolute points
+    Return absolute points for a run of M, L, H or V segments
     """
 
-    if command.upper() == "H":
-        segment.insert(1, cursor[1] if absolute else 0)
-    if command.upper() == "V":
-        segment.insert(0, cursor[0] if absolute else 0)
+    values = np.asarray(values, dtype=np.float64)
+    command = command.upper()
 
-    if absolute:
-        return [list(segment)]
+    if command == "H":
+        other = np.full(len(values), cursor[1] if absolute else 0)
+        pts = np.column_stack([values, other])
+    elif command == "V":
+        other = np.full(len(values), cursor[0] if absolute else 0)
+        pts = np.column_stack([other, values])
+    else:
+        pts = values.reshape(-1, 2)
 
-    return [[
-        cursor[0] + segment[0],
-        cursor[1] + segment[1],
-    ]]
+    if not absolute:
+        pts = accumulate(cursor, pts)
 
+    return pts.tolist()
 
 
-def path_to_poly_list(path):
-    path = " " + clean_whitespace(path)
-    path = re.compile(" ([mlhvzcsqta])([0-9-])", re.I).sub(r"\1 \2", path)
-    path = re.sub(",", " ", path)
+
+def parse_numbers(text):
+    """
+    Return a list of floats from whitespace or comma separated text.
+
+    Long runs are parsed in C by `np.fromstring`, falling back to the
+    regex when it cannot read the whole text, eg. for compact forms like
+    "10-5" or ".5.5".
+    """
+
+    if len(text) >= _FROMSTRING_MIN_LENGTH:
+        if "," in text:
+            text = text.translate(_COMMA_TABLE)
+        text = text.rstrip()
+        with warnings.catch_warnings():
+            # Older NumPy warns, and returns a partial result, on unread
+            # data instead of raising.
+            warnings.simplefilter("error", DeprecationWarning)
+            try:
+                return np.fromstring(text, sep=" ").tolist()
+            except (ValueError, DeprecationWarning):
+                pass
+
+    return [float(v) for v in _RE_PATH_NUMBER.findall(text)]
+
+
+
+def tokenize_path(path):
+    """
+    Yield `(command, values)` pairs from SVG path data in a single pass.
+
+    Numbers need not be separated by whitespace or commas where the
+    grammar allows it, eg. "M10-5l.5.5".
+    """
+
+    for match in _RE_PATH_COMMAND.finditer(path):
+        (command, text) = match.groups()
+        yield command, parse_numbers(text)
+
+
+
+def path_to_poly_list(path, tolerance=BEZIER_TOLERANCE):
+    """
+    Return a list of polygons for SVG path data.
+
+    `tolerance` is the flattening tolerance for curves, in path units.
+    """
 
     handlers = {
         "M": {
@@ -155,18 +344,16 @@ def path_to_poly_list(path):
         },
         "C": {
             "length": 6,
-            "path": poly_points_bezier,
+            "path": functools.partial(
+                poly_points_bezier, tolerance=tolerance),
         },
     }
 
 
     poly_list = [[]]
     cursor = [0, 0]
-    command_list = re.compile(" ([mlhvzcsqta])", re.I).split(path)[1:]
-    for i in range(0, len(command_list), 2):
-        command = command_list[i]
+    for command, values in tokenize_path(path):
         absolute = command == command.upper()
-        values = clean_whitespace(command_list[i + 1]).split()
 
         try:
             handler = handlers[command.upper()]
@@ -175,161 +362,110 @@ def path_to_poly_list(path):
                       command, values)
             break
 
-        try:
-            values = [float(v) for v in values]
-        except ValueError:
-            LOG.error("Could not convert all values to float: %s",
-                      values)
-            break
-
         if handler.get("draw", True) is False:
             if poly_list[-1]:
                 poly_list.append([])
 
-        while values:
-            segment = values[:handler["length"]]
-            values = values[handler["length"]:]
-            if "value" in handler:
-                segment = handler["value"](segment)
-
-            if not "path" in handler:
-                break
+        length = handler["length"]
+        if length and len(values) % length:
+            LOG.error("Ignoring trailing values for path segment: %s %s",
+                      command, values[-(len(values) % length):])
+            values = values[:-(len(values) % length)]
 
+        if values and "path" in handler:
+            # Each handler returns the points for the whole run of
+            # segments at once.
             vertex_list = handler["path"](
-                command, cursor, segment, absolute)
-
-            for vertex in vertex_list:
-                cursor = list(vertex)
-                poly_list[-1].append(cursor)
+                command, cursor, values, absolute)
+            poly_list[-1] += vertex_list
+            cursor = list(vertex_list[-1])
 
         if command.upper() == "Z":
             poly_list[-1].append(poly_list[-1][0])
 
 
-    poly_list = [[(v[0], v[1]) for v in poly] for poly in poly_list]
-
     return poly_list
 
 
 
-def parse_transform(text):
+def _parse_transform(text):
     text = clean_whitespace(text)
 
-    match = re.compile(r"""
-matrix\(
-([0-9.e-]+),
-([0-9.e-]+),
-([0-9.e-]+),
-([0-9.e-]+),
-([0-9.e-]+),
-([0-9.e-]+)
-\)""", re.X).match(text)
+    match = _RE_XFORM_MATRIX.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
-        return np.matrix((
+        return np.array((
             [xform[0], xform[2], xform[4]],
             [xform[1], xform[3], xform[5]],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
-    match = re.compile(r"""
-translate\(
-([0-9.e-]+),
-([0-9.e-]+)
-\)
-""", re.X).match(text)
+    match = _RE_XFORM_TRANSLATE.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
-        return np.matrix((
+        return np.array((
             [1, 0, xform[0]],
             [0, 1, xform[1]],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
-    match = re.compile(r"""
-translate\(
-([0-9.e-]+)
-\)
-""", re.X).match(text)
+    match = _RE_XFORM_TRANSLATE1.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
-        return np.matrix((
+        return np.array((
             [1, 0, xform[0]],
             [0, 1, 0],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
-    match = re.compile(r"""
-rotate\(
-([0-9.e-]+)
-\)
-""", re.X).match(text)
+    match = _RE_XFORM_ROTATE.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
         theta = math.radians(xform[0])
-        return np.matrix((
+        return np.array((
             [math.cos(theta), math.sin(theta), 0],
             [-math.sin(theta), math.cos(theta), 0],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
-    match = re.compile(r"""
-rotate\(
-([0-9.e-]+),
-([0-9.e-]+),
-([0-9.e-]+)
-\)
-""", re.X).match(text)
+    match = _RE_XFORM_ROTATE3.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
         theta = math.radians(xform[0])
-        return np.matrix((
-            [1, 0, xform[1]],
-            [0, 1, xform[2]],
-            [0, 0, 1]
-        )) * np.matrix((
-            [math.cos(theta), -math.sin(theta), 0],
-            [math.sin(theta), math.cos(theta), 0],
-            [0, 0, 1]
-        )) * np.matrix((
-            [1, 0, -xform[1]],
-            [0, 1, -xform[2]],
+        (cx, cy) = xform[1:]
+        (c, s) = (math.cos(theta), math.sin(theta))
+        # Rotation about (cx, cy), ie. translate(cx, cy) rotate(a)
+        # translate(-cx, -cy), composed into a single matrix.
+        return np.array((
+            [c, -s, cx - c * cx + s * cy],
+            [s, c, cy - s * cx - c * cy],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
-    match = re.compile(r"""
-scale\(
-([0-9.e-]+),
-([0-9.e-]+)
-\)
-""", re.X).match(text)
+    match = _RE_XFORM_SCALE.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
-        return np.matrix((
+        return np.array((
             [xform[0], 0, 0],
             [0, xform[1], 0],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
-    match = re.compile(r"""
-scale\(
-([0-9.e-]+)
-\)
-""", re.X).match(text)
+    match = _RE_XFORM_SCALE1.match(text)
     if match:
-        LOG.debug("transform: %s" % match.group(0))
+        LOG.debug("transform: %s", match.group(0))
         xform = [float(v) for v in match.groups()]
-        return np.matrix((
+        return np.array((
             [xform[0], 0, 0],
             [0, xform[0], 0],
             [0, 0, 1]
-        ))
+        ), dtype=np.float64)
 
     LOG.warning(
         "No transform procedure defined for '%s'", text)
@@ -338,50 +474,96 @@ scale\(
 
 
 
-def extract_paths(node, xform=None, depth=None):
+@functools.lru_cache(maxsize=1024)
+def parse_transform(text):
+    """
+    Return a 3x3 ndarray for an SVG transform attribute, or `None`.
+
+    Results are cached per transform string and shared between callers,
+    so they are returned read-only.
+    """
+
+    xform = _parse_transform(text)
+    if xform is not None:
+        xform.setflags(write=False)
+    return xform
+
+
+
+def split_tag(tag):
+    """
+    Return `(namespace, localname)` for an lxml "{namespace}name" tag.
+    """
+
+    if tag[0] == "{":
+        return tuple(tag[1:].split("}", 1))
+    return None, tag
+
+
+
+def extract_paths(root, xform=None):
+    """
+    Return transformed polygons for `root` and its descendants.
+
+    The tree is walked depth-first with an explicit stack of
+    `(node, xform)` pairs. Each `xform` is shared by every descendant of
+    the node it was composed for and must be treated as immutable;
+    composing with a child transform creates a new array.
+    """
+
     if xform is None:
         xform = np.identity(3)
-    if depth is None:
-        depth = 0
 
-    if not hasattr(node, "name") or node.name is None:
-        return []
+    debug = LOG.isEnabledFor(logging.DEBUG)
 
     paths = []
+    stack = [(root, xform)]
 
-    if hasattr(node, "attrs") and "transform" in node.attrs:
-        LOG.debug("transform raw: %s %s", node.name, node["transform"])
-        xform_ = parse_transform(node["transform"])
-        if xform_ is not None:
-            xform = xform * xform_
-
-    if node.name == "path":
-        path = node.attrs["d"]
-        poly_list = path_to_poly_list(path)
-        poly_list = [transform_poly(poly, xform) for poly in poly_list]
-        paths += poly_list
-
-    elif node.name in ["svg", "g"]:
-        label = node.get("inkscape:label", None)
-        style = node.get("style", "")
-        if "display:none" not in style:
-            if label:
-                LOG.info(label)
-            for child in node:
-                paths += extract_paths(child, np.copy(xform), depth + 1)
-        else:
-            if label:
-                LOG.debug(label)
+    while stack:
+        (node, xform) = stack.pop()
 
+        if not isinstance(node.tag, str):
+            # Comments and processing instructions.
+            continue
 
-    elif node.name.startswith("sodipodi"):
-        pass
+        (namespace, name) = split_tag(node.tag)
 
-    elif node.name in ["metadata", "defs"]:
-        pass
+        # Prune non-rendering subtrees before reading any attributes.
+        if namespace == NS_SODIPODI or name in SKIP_TAGS:
+            continue
 
-    else:
-        LOG.warning("Ignoring node: %s", node.name)
+        if name not in ["path", "svg", "g"]:
+            LOG.warning("Ignoring node: %s", name)
+            continue
+
+        if name != "path":
+            label = node.get("{%s}label" % NS_INKSCAPE, None)
+            if "display:none" in node.get("style", ""):
+                if label:
+                    LOG.debug(label)
+                continue
+            if label:
+                LOG.info(label)
+
+        transform = node.get("transform", None)
+        if transform is not None:
+            if debug:
+                LOG.debug("transform raw: %s %s", name, transform)
+            xform_ = parse_transform(transform)
+            if xform_ is not None:
+                xform = xform @ xform_
+
+        if name == "path":
+            path = node.attrib["d"]
+            # Largest scale factor of the transform, so that curves are
+            # flattened to `BEZIER_TOLERANCE` in output units.
+            scale = np.linalg.norm(xform[:2, :2], 2)
+            tolerance = BEZIER_TOLERANCE / scale if scale else BEZIER_TOLERANCE
+            paths += transform_poly_list(
+                path_to_poly_list(path, tolerance), xform)
+        else:
+            # Reversed so that children are popped in document order.
+            stack.extend((child, xform) for child in reversed(node))
 
     return paths
 
@@ -392,14 +574,13 @@ def svg2paths(svg_file):
 
     svg_text = svg_file.read()
 
-    soup = BeautifulSoup(svg_text, "lxml")
-
-    svg = soup.find("svg")
+    parser = etree.XMLParser(huge_tree=True, recover=True)
+    svg = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
     xform = None
 
     width = svg.get("width", None)
     height = svg.get("height", None)
-    viewbox = svg.get("viewbox", None)
+    viewbox = svg.get("viewBox", None)
 
     if width and height and viewbox:
         width = text_to_mm(width)
@@ -414,11 +595,11 @@ def svg2paths(svg_file):
         LOG.info("View box: %0.3f %0.3f %0.3f %0.3f", *viewbox)
         LOG.info("Unit scale: %0.3f, %0.3f", *unit_scale)
 
-        xform = np.matrix([
+        xform = np.array([
             [unit_scale[0], 0, 0],
             [0, -unit_scale[1], height],
             [0, 0, 1]
-        ])
+        ], dtype=np.float64)
 
     paths = extract_paths(svg, xform)
 
@@ -20,6 +20,10 @@ color_log(LOG)
 
 
 
+_RE_CONTINUATION = re.compile(r"\s*\\\n\s*")
+
+
+
 def obj2svg(out, obj_file, unit=""):
     LOG.info(obj_file.name)
 
@@ -28,44 +32,57 @@ def obj2svg(out, obj_file, unit=""):
     vert_list = []
     face_list = []
 
-    obj_text = re.compile(r"\s*\\\n\s*").sub(" ", obj_text)
+    obj_text = _RE_CONTINUATION.sub(" ", obj_text)
 
-    x_min = None
-    y_min = None
-    x_max = None
-    y_max = None
+    x_min = y_min = float("inf")
+    x_max = y_max = float("-inf")
 
     for line in obj_text.splitlines():
-        line = re.sub("#.*$", "", line)
-        line = line.strip()
+        line = line.partition("#")[0].strip()
         if not line:
             continue
 
-        g_match = re.match("g", line)
-        if g_match:
+        head = line[:2]
+
+        if head[0] == "g":
             continue
 
-        vn_match = re.match("vn ([-0-9e.]+) ([-0-9e.]+) ([-0-9e.]+)", line)
-        if vn_match:
+        if head == "vn":
             continue
 
-        v_match = re.match("v ([-0-9e.]+) ([-0-9e.]+) ([-0-9e.]+)", line)
-        if v_match:
-            point = [float(v) for v in v_match.groups()]
-            (x, y, z) = point
-            x_min = x if x_min is None else min(x_min, x)
-            y_min = y if y_min is None else min(y_min, y)
-            x_max = x if x_max is None else max(x_max, x)
-            y_max = y if y_max is None else max(y_max, y)
+        if head == "v ":
+            try:
+                point = [float(v) for v in line.split()[1:4]]
+                (x, y, z) = point
+            except ValueError:
+                LOG.error(line)
+                sys.exit(1)
+            if x < x_min:
+                x_min = x
+            if x > x_max:
+                x_max = x
+            if y < y_min:
+                y_min = y
+            if y > y_max:
+                y_max = y
             if Z_WARN_NON_ZERO and z != 0:
                 LOG.warning("Point is not in z-plane")
                 sys.exit(1)
             vert_list.append(point)
             continue
 
-        f_match = re.match("f( [-0-9e./]+)+$", line)
-        if f_match:
-            face = [int(v.split("/")[0]) for v in line.split()[1:]]
+        if head == "f ":
+            # Negative indices count back from the latest vertex.
+            count = len(vert_list) + 1
+            try:
+                face = [
+                    index if index > 0 else count + index
+                    for index in (
+                        int(v.split("/")[0]) for v in line.split()[1:])
+                ]
+            except ValueError:
+                LOG.error(line)
+                sys.exit(1)
             face_list.append(face)
             continue
 
@@ -83,6 +100,9 @@ def obj2svg(out, obj_file, unit=""):
 
 
 def remove_backtracks(face_list):
+    # Checked once so that per-edge logging costs nothing when disabled.
+    verbose = LOG.isEnabledFor(logging.INFO)
+
     line_dict = defaultdict(int)
 
     for face in face_list:
@@ -94,12 +114,14 @@ def remove_backtracks(face_list):
                 continue
             pair = tuple(sorted([cursor, vert]))
             line_dict[pair] += 1 if vert > cursor else -1
-            LOG.info(pair)
+            if verbose:
+                LOG.info(pair)
             cursor = vert
 
     line_dict = dict(line_dict)
-    LOG.info(sorted(line_dict.items()))
-    LOG.info("")
+    if verbose:
+        LOG.info(sorted(line_dict.items()))
+        LOG.info("")
 
     line_soup = defaultdict(list)
     for key, value in line_dict.items():
@@ -109,8 +131,9 @@ def remove_backtracks(face_list):
             line_soup[key[1]] += [key[0]] * -value
 
     line_soup = dict(line_soup)
-    LOG.info(repr(line_soup))
-    LOG.info("")
+    if verbose:
+        LOG.info(repr(line_soup))
+        LOG.info("")
 
     poly_list = [[]]
     while line_soup:
@@ -141,8 +164,9 @@ def remove_backtracks(face_list):
             del line_soup[e1]
         poly_list[-1].append(e2)
 
-    LOG.info(repr(poly_list))
-    LOG.info("")
+    if verbose:
+        LOG.info(repr(poly_list))
+        LOG.info("")
 
     return poly_list
 
@@ -150,17 +174,17 @@ def remove_backtracks(face_list):
 
 
 def write_svg(out, face_list, vert_list, width, height, unit):
-    out.write('''<svg
+    parts = ['''<svg
   xmlns:svg="http://www.w3.org/2000/svg"
   xmlns="http://www.w3.org/2000/svg"
   width="%f%s"
   height="%f%s"
   viewBox="%f %f %f %f"
 >
-''' % (width, unit, height, unit, 0, 0, width, height))
+''' % (width, unit, height, unit, 0, 0, width, height)]
 
     if unit:
-        out.write('''<sodipodi:namedview
+        parts.append('''<sodipodi:namedview
      inkscape:document-units="%s"
      units="%s"
 />
@@ -168,16 +192,15 @@ def write_svg(out, face_list, vert_list, width, height, unit):
 
 
     for face in face_list:
-        out.write('  <path style="fill:none;stroke:#000000;stroke-width:0.1;stroke-miterlimit:4;stroke-dasharray:none" d=\"')
-        for i, v in enumerate(face):
-            vert = vert_list[v - 1]
-            out.write(" %s%f %f" % (
-                "M" if i == 0 else "L",
-                vert[0],
-                vert[1],
-            ))
-        out.write(' Z"/>\n')
-    out.write('</svg>')
+        path_d = "".join([
+            f" {'M' if i == 0 else 'L'}"
+            f"{vert_list[v - 1][0]:f} {vert_list[v - 1][1]:f}"
+            for i, v in enumerate(face)
+        ])
+        parts.append('  <path style="fill:none;stroke:#000000;stroke-width:0.1;stroke-miterlimit:4;stroke-dasharray:none" d=\"%s Z"/>\n' % path_d)
+    parts.append('</svg>')
+
+    out.write("".join(parts))
 
     LOG.info("%s faces.", len(face_list))
 
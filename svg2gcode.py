@@ -4,13 +4,14 @@
 
 import os
 import sys
-import math
 import shutil
 import logging
 import argparse
 from collections import defaultdict
 from tempfile import NamedTemporaryFile
 
+import numpy as np
+
 from common import color_log
 
 from geo import svg2paths
@@ -59,21 +60,21 @@ M420 S1 Z5 V           ; Activate bed levelling with 5mm fade and print table
     out.write("G1 Z%0.3f F4000\n" % z_move)
     out.write("G1 X%0.3f Y%0.3f F4000\n" % (offset["x"], offset["y"]))
 
-    for path in paths:
-        out.write("G1 X%0.3f Y%0.3f F4000\n" % (
-            offset["x"] + path[0][0], offset["y"] + path[0][1]))
-        out.write("G1 Z%0.3f F4000\n" % z_plot)
-
-        for vert in path[1:]:
-            out.write("G0 X%0.3f Y%0.3f F4000\n" % (
-                offset["x"] + vert[0], offset["y"] + vert[1]))
-
-        out.write("G1 Z%0.3f F4000\n" % z_move)
-
+    (x_offset, y_offset) = (offset["x"], offset["y"])
 
+    for path in paths:
+        lines = [
+            f"G1 X{x_offset + path[0][0]:0.3f} "
+            f"Y{y_offset + path[0][1]:0.3f} F4000",
+            f"G1 Z{z_plot:0.3f} F4000",
+        ]
+        lines += [
+            f"G0 X{x_offset + vert[0]:0.3f} Y{y_offset + vert[1]:0.3f} F4000"
+            for vert in path[1:]
+        ]
+        lines.append(f"G1 Z{z_move:0.3f} F4000")
 
-def dist2d(a, b):
-    return math.sqrt(pow(b[0] - a[0], 2) + pow(b[1] - a[1], 2))
+        out.write("\n".join(lines) + "\n")
 
 
 
@@ -96,9 +97,20 @@ def order_paths(path_list, allow_reverse=False):
                 "reverse": True
             })
 
+    # Candidate points in index order. Points are only ever removed from
+    # `index`, so a mask over this array tracks which remain.
+    point_list = list(index.keys())
+    point_index = {point: i for i, point in enumerate(point_list)}
+    point_array = np.array(point_list, dtype=np.float64).reshape(-1, 2)
+    alive = np.ones(len(point_list), dtype=bool)
+
     out_list = []
     cursor = (0, 0)
 
+    def remove_point(point):
+        del index[point]
+        alive[point_index[point]] = False
+
     def add_item(start):
         nonlocal index
         nonlocal cursor
@@ -106,7 +118,7 @@ def order_paths(path_list, allow_reverse=False):
 
         item = index[start].pop(0)
         if not index[start]:
-            del index[start]
+            remove_point(start)
         i = item["i"]
         path = path_list[i]
 
@@ -116,20 +128,19 @@ def order_paths(path_list, allow_reverse=False):
             end = tuple(path[-1])
             index[end] = [v for v in index[end] if v["i"] != i]
             if not index[end]:
-                del index[end]
+                remove_point(end)
 
         out_list.append(path)
         cursor = path[-1]
 
     while index:
-        lo_point = None
-        lo_dist = None
-        for point in index.keys():
-            dist = dist2d(cursor, point)
-            if lo_dist is None or dist < lo_dist:
-                lo_dist = dist
-                lo_point = point
-        add_item(lo_point)
+        # Squared distance is monotonic in distance, so it picks the same
+        # nearest point without taking square roots.
+        dx = point_array[:, 0] - cursor[0]
+        dy = point_array[:, 1] - cursor[1]
+        dist2 = dx * dx + dy * dy
+        dist2[~alive] = np.inf
+        add_item(point_list[int(np.argmin(dist2))])
 
     return out_list
 
@@ -2,6 +2,7 @@
 
 # pylint: disable=logging-too-many-args
 
+import io
 import os
 import sys
 import shutil
@@ -9,6 +10,8 @@ import logging
 import argparse
 from tempfile import NamedTemporaryFile
 
+import numpy as np
+
 from common import color_log
 
 from geo import svg2paths
@@ -23,7 +26,7 @@ def svg2obj(out, svg_file):
     """
     Write paths in OBJ format.
 
-    out:  Stream object to write to.
+    out:  Binary stream object to write to.
 
     Use millimeters for output unit.
     """
@@ -33,29 +36,61 @@ def svg2obj(out, svg_file):
 
 
 
+def unique_vertices(vertices):
+    """
+    Return `(unique, index)` for an (N, 2) array of vertices.
+
+    `unique` holds each distinct vertex, compared to six decimal places,
+    in order of first appearance. `index` maps every input vertex to its
+    row in `unique`.
+    """
+
+    # Adding zero folds -0.0 into 0.0, which would otherwise compare
+    # unequal as raw bytes.
+    keys = np.round(vertices, 6) + 0.0
+    (_, first, inverse) = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True)
+
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return vertices[first[order]], rank[inverse.reshape(-1)]
+
+
+
 def write_obj(out, paths):
     """
-    Vertex numbers start from 1.
+    Vertex numbers start from 1. `out` is a binary stream; OBJ output is
+    ASCII so it is formatted as bytes directly.
+
+    Vertices that coincide to the precision written are shared between
+    faces rather than repeated. Consecutive repeats within a face, such as
+    an explicit closing point followed by `Z`, are written once so that
+    faces have no zero-length edges.
     """
 
-    vertex_list = []
-    face_list = []
-
-    for path in paths:
-        face = []
-        for vertex in path:
-            vertex_list.append(vertex)
-            v = len(vertex_list)
-            face.append(v)
-        face_list.append(face)
-
-    out.write("g\n")
-    for vertex in vertex_list:
-        out.write("v %f %f 0\n" % (vertex[0], vertex[1]))
-    for face in face_list:
-        out.write("f %s\n" % " ".join(["%d" % v for v in face]))
+    sizes = [len(path) for path in paths]
+    vertices = np.concatenate(
+        [np.asarray(path, dtype=np.float64).reshape(-1, 2)
+         for path in paths] or [np.empty((0, 2))])
+    (vertices, index) = unique_vertices(vertices)
+    index = (index + 1).tolist()
+
+    buf = io.BytesIO()
+    buf.write(b"g\n")
+    np.savetxt(buf, vertices, fmt="v %f %f 0")
+
+    start = 0
+    for size in sizes:
+        face = index[start:start + size]
+        face = [v for (i, v) in enumerate(face) if not i or v != face[i - 1]]
+        buf.write(b"f %s\n" % " ".join(map(str, face)).encode("ascii"))
+        start += size
+
+    out.write(buf.getvalue())
     LOG.info("Wrote %d vertices and %d faces.",
-             len(vertex_list), len(face_list))
+             len(vertices), len(sizes))
 
 
 
@@ -95,10 +130,10 @@ def main():
         log.setLevel(level)
 
     if args.obj:
-        out = NamedTemporaryFile("w", encoding="utf=8", delete=False)
+        out = NamedTemporaryFile("wb", delete=False)
         os.fchmod(out.fileno(), os.stat(args.svg).st_mode)
     else:
-        out = sys.stdout
+        out = sys.stdout.buffer
 
     with open(args.svg, "r", encoding="utf-8") as svg:
         svg2obj(out, svg)